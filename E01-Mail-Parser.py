@@ -1,13 +1,20 @@
 from aspose.email.storage.pst import PersonalStorage
 from datetime import timezone, timedelta
+import threading
+import tempfile
+import shutil
 import hashlib
 import pytsk3
 import pyewf
+import heapq
+import queue
 import glob
 import sys
 import csv
 import os
 
+CSV_FIELDNAMES = ["source_account", "folder_name", "sender_email", "sender_name", "receiver_emails", "cc_emails", "bcc_emails", "delivery_time_unixtime", "subject", "attachments", "body"]
+
 # ==================== E01_to_ost_and_pst ==================== #
 
 class EWFImgInfo(pytsk3.Img_Info):
@@ -48,7 +55,7 @@ def format_title(title):
     right_padding = total_length - (left_padding + len(title))
     return ' ' + '=' * left_padding + ' ' + title + ' ' + '=' * right_padding + ' '
 
-def print_all_partitions_with_windows_directory(img_info, output_dir, img_path):
+def print_all_partitions_with_windows_directory(img_info, output_dir, img_path, pipeline=None):
     title = format_title(os.path.basename(img_path))
     print(f'\n{title}')
     try:
@@ -58,7 +65,7 @@ def print_all_partitions_with_windows_directory(img_info, output_dir, img_path):
                 fs = pytsk3.FS_Info(img_info, offset=partition.start * 512)
                 if fs.info.ftype == pytsk3.TSK_FS_TYPE_NTFS and has_windows_directory(fs):
                     print(f" Partition Name : {partition.desc.decode()}")
-                    extract_count = print_users_directories_with_outlook(fs, output_dir)
+                    extract_count = print_users_directories_with_outlook(fs, output_dir, pipeline)
                     print(f" Extracted : {extract_count}")
             except Exception as e:
                 pass
@@ -76,7 +83,7 @@ def has_windows_directory(fs):
         print(f" Error checking for 'Windows' directory: {str(e)}")
     return False
 
-def print_users_directories_with_outlook(fs, output_dir):
+def print_users_directories_with_outlook(fs, output_dir, pipeline=None):
     extracted_files = 0
     try:
         users_dir = fs.open_dir(path="/Users")
@@ -85,17 +92,20 @@ def print_users_directories_with_outlook(fs, output_dir):
                 dir_name = entry.info.name.name.decode()
                 if dir_name not in [".", ".."]:
                     if contains_appdata_directory(fs, f"/Users/{dir_name}"):
-                        ost_files = extract_files(fs, f"/Users/{dir_name}/AppData/Local/Microsoft/Outlook", output_dir, '.ost')
-                        pst_files = extract_files(fs, f"/Users/{dir_name}/OneDrive/문서/Outlook Files", output_dir, '.pst')
+                        ost_files = extract_files(fs, f"/Users/{dir_name}/AppData/Local/Microsoft/Outlook", output_dir, '.ost', pipeline)
+                        pst_files = extract_files(fs, f"/Users/{dir_name}/OneDrive/문서/Outlook Files", output_dir, '.pst', pipeline, dir_name if ost_files else None)
                         if ost_files:
                             print(f"    User Name : {dir_name}")
                             print("        (Outlook-OST-Directory O)")
+                            not_copied = " (not copied: --max-temp-disk)" if pipeline and not pipeline.copy_unconverted else ""
                             for file in ost_files:
-                                print(f"            - {file}")
-                            list_outlook_files(fs, dir_name, output_dir)
+                                print(f"            - {file}{not_copied}")
+                            list_outlook_files(fs, dir_name, output_dir, pipeline)
 
                             extracted_files += len(ost_files)
                             extracted_files += len(pst_files)
+                        if pipeline:
+                            pipeline.queued_names.clear()
     except Exception as e:
         print(f" Failed to list Users subdirectories: {str(e)}")
     return extracted_files
@@ -111,7 +121,7 @@ def contains_appdata_directory(fs, path):
         print(f" Error checking for 'AppData' directory in {path}: {str(e)}")
     return False
 
-def extract_files(fs, path, output_dir, extension):
+def extract_files(fs, path, output_dir, extension, pipeline=None, convert_user=None):
     extracted_files = []
     try:
         outlook_dir = fs.open_dir(path=path)
@@ -120,15 +130,18 @@ def extract_files(fs, path, output_dir, extension):
                 file_name = entry.info.name.name.decode()
                 if file_name.lower().endswith(extension):
                     file_path = os.path.join(output_dir, file_name)
-                    with open(file_path, 'wb') as f:
-                        file_data = entry.read_random(0, entry.info.meta.size)
-                        f.write(file_data)
+                    if pipeline:
+                        pipeline_extract_entry(entry, file_path, file_name, pipeline, convert_user)
+                    else:
+                        with open(file_path, 'wb') as f:
+                            file_data = entry.read_random(0, entry.info.meta.size)
+                            f.write(file_data)
                     extracted_files.append(file_name)
     except Exception as e:
         pass
     return extracted_files
 
-def list_outlook_files(fs, dir_name, output_dir):
+def list_outlook_files(fs, dir_name, output_dir, pipeline=None):
     path = f"/Users/{dir_name}/OneDrive/문서/Outlook Files"
     try:
         outlook_files_dir = fs.open_dir(path=path)
@@ -137,10 +150,14 @@ def list_outlook_files(fs, dir_name, output_dir):
         for entry in outlook_files_dir:
             if entry.info.meta and entry.info.meta.type == pytsk3.TSK_FS_META_TYPE_REG:
                 file_name = entry.info.name.name.decode()
+                if pipeline:
+                    pipeline.queue_mailbox(output_dir, dir_name, file_name)
+                    continue
                 print(f"            - {file_name}", end="")
 
                 full_path = os.path.join(output_dir, file_name)
-                pst_to_csv('.\\' + full_path[2:])
+                csv_filename = pst_to_csv('.\\' + full_path[2:])
+                print(f" -> {os.path.basename(csv_filename)}")
         has_files = True
                 
         if not has_files:
@@ -148,6 +165,12 @@ def list_outlook_files(fs, dir_name, output_dir):
     except Exception as e:
         print("        (Outlook-PST-Directory X)")
 
+def get_output_directory(img_path, hash_value):
+    output_directory_name = os.path.basename(img_path) + '-' + hash_value
+    output_directory = os.path.join("./extracted_files", output_directory_name)
+    os.makedirs(output_directory, exist_ok=True)
+    return output_directory
+
 def E01_to_ost_and_pst(img_path):
     img_type = get_file_type(img_path)
     hasher = hashlib.sha256()
@@ -162,9 +185,7 @@ def E01_to_ost_and_pst(img_path):
         sys.exit(1)
 
     hash_value = hasher.hexdigest()
-    output_directory_name = os.path.basename(img_path) + '-' + hash_value
-    output_directory = os.path.join("./extracted_files", output_directory_name)
-    os.makedirs(output_directory, exist_ok=True)
+    output_directory = get_output_directory(img_path, hash_value)
 
     img_info = read_image_file(img_path, img_type)
     print_all_partitions_with_windows_directory(img_info, output_directory, img_path)
@@ -194,13 +215,10 @@ def load_pst_messages(pst, folder_name):
 def create_csv_for_pst(pst, pst_file, messages_info, source_account):
     csv_filename = f"{os.path.splitext(pst_file)[0]}.csv"
     with open(csv_filename, 'w', newline='', encoding='utf-8-sig') as csvfile:
-        fieldnames = ["source_account", "folder_name", "sender_email", "sender_name", "receiver_emails", "cc_emails", "bcc_emails", "delivery_time_unixtime", "subject", "attachments", "body"]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDNAMES)
         writer.writeheader()
         for folder_name, messages in messages_info.items():
             display_message_info(messages, pst, folder_name, writer, source_account)
-    csv_base_name = os.path.basename(csv_filename)
-    print(f" -> {csv_base_name}")
     return csv_filename
 
 def display_message_info(messages, pst, folder_name, writer, source_account):
@@ -255,14 +273,16 @@ def pst_to_csv(pst_file):
             messages = load_pst_messages(pst, folder_name)
             messages_info[folder_name] = messages
 
-        create_csv_for_pst(pst, pst_file, messages_info, source_account)
+        return create_csv_for_pst(pst, pst_file, messages_info, source_account)
 
 # ==================== merge_and_sort_csv_files ==================== #
 
+def get_delivery_time(row):
+    return int(row['delivery_time_unixtime']) if row['delivery_time_unixtime'] else 0
+
 def merge_and_sort_csv_files(directory):
     csv_files = glob.glob(os.path.join(directory, '**', '*.csv'), recursive=True)
     all_data = []
-    fieldnames = ["source_account", "folder_name", "sender_email", "sender_name", "receiver_emails", "cc_emails", "bcc_emails", "delivery_time_unixtime", "subject", "attachments", "body"]
     num_files_merged = len(csv_files)
     
     for csv_file in csv_files:
@@ -271,26 +291,386 @@ def merge_and_sort_csv_files(directory):
             for row in reader:
                 all_data.append(row)
 
-    all_data.sort(key=lambda x: int(x['delivery_time_unixtime']) if x['delivery_time_unixtime'] else 0)
+    all_data.sort(key=get_delivery_time)
 
     merged_filename = os.path.join(".", 'extract.csv')
     with open(merged_filename, 'w', newline='', encoding='utf-8-sig') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDNAMES)
         writer.writeheader()
         for data in all_data:
             writer.writerow(data)
 
     print(f"\n{num_files_merged} CSV files merged and sorted into '{merged_filename}'\n")
 
+# ======================== pipeline ======================== #
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+SORT_RUN_SIZE = 64 * 1024 * 1024
+MERGE_FAN_IN = 32
+QUEUE_SIZE = 2
+POLL_INTERVAL = 0.1
+
+class PipelineStopped(BaseException):
+    pass
+
+class ResourceBudget:
+    def __init__(self, limit, stop_event):
+        self.limit = limit
+        self.used = 0
+        self._stop_event = stop_event
+        self._condition = threading.Condition()
+
+    def chunk(self, size):
+        if self.limit is None:
+            return size
+        return min(size, max(1, self.limit // 4))
+
+    def acquire(self, size):
+        if self.limit is None:
+            return size
+        size = min(size, self.limit)
+        with self._condition:
+            while self.used + size > self.limit:
+                if self._stop_event.is_set():
+                    raise PipelineStopped("pipeline stopped")
+                self._condition.wait(POLL_INTERVAL)
+            self.used += size
+        return size
+
+    def release(self, size):
+        if self.limit is None:
+            return
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+class MailPipeline:
+    def __init__(self, max_memory, max_temp_disk):
+        self.stop_event = threading.Event()
+        self.memory = ResourceBudget(max_memory, self.stop_event)
+        self.disk = ResourceBudget(max_temp_disk, self.stop_event)
+        self.delete_mailboxes = max_temp_disk is not None
+        self.copy_unconverted = max_temp_disk is None
+        self.hash_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.mailbox_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.csv_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.claimed_paths = set()
+        self.queued_names = set()
+        self.failed = False
+
+    def stop(self):
+        self.failed = True
+        self.stop_event.set()
+
+    def check_stopped(self):
+        if self.stop_event.is_set():
+            raise PipelineStopped("pipeline stopped")
+
+    def put(self, target_queue, item):
+        while True:
+            self.check_stopped()
+            try:
+                target_queue.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def claim_path(self, file_path):
+        root, ext = os.path.splitext(file_path)
+        suffix = 1
+        while file_path in self.claimed_paths:
+            file_path = f"{root}-{suffix}{ext}"
+            suffix += 1
+        self.claimed_paths.add(file_path)
+        return file_path
+
+    def queue_mailbox(self, output_dir, dir_name, file_name):
+        if file_name not in self.queued_names:
+            self.put(self.mailbox_queue, (os.path.join(output_dir, file_name), 0, f"{dir_name}/{file_name}", False))
+
+    def get(self, source_queue):
+        while True:
+            self.check_stopped()
+            try:
+                return source_queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+
+def parse_size(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        size = int(float(value[:-1]) * units[value[-1]])
+    else:
+        size = int(value)
+    if size <= 0:
+        raise ValueError(f"size must be positive: {value}")
+    return size
+
+def hash_image_file(img_path, pipeline):
+    memory = pipeline.memory
+    hasher = hashlib.sha256()
+    try:
+        with open(img_path, 'rb') as afile:
+            buf = True
+            while buf:
+                pipeline.check_stopped()
+                chunk_size = memory.acquire(memory.chunk(HASH_CHUNK_SIZE))
+                try:
+                    buf = afile.read(chunk_size)
+                    hasher.update(buf)
+                finally:
+                    memory.release(chunk_size)
+    except IOError as e:
+        print(f" Unable to open file {img_path}: {str(e)}")
+        return None
+    return hasher.hexdigest()
+
+def pipeline_extract_entry(entry, file_path, file_name, pipeline, convert_user):
+    if not convert_user and not pipeline.copy_unconverted:
+        return
+    file_path = pipeline.claim_path(file_path)
+    size = entry.info.meta.size
+    reserved = pipeline.disk.acquire(size) if convert_user else 0
+    try:
+        with open(file_path, 'wb') as f:
+            offset = 0
+            while offset < size:
+                pipeline.check_stopped()
+                chunk_size = pipeline.memory.acquire(min(pipeline.memory.chunk(COPY_CHUNK_SIZE), size - offset))
+                try:
+                    f.write(entry.read_random(offset, chunk_size))
+                finally:
+                    pipeline.memory.release(chunk_size)
+                offset += chunk_size
+    except BaseException:
+        pipeline.disk.release(reserved)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+    if convert_user:
+        pipeline.queued_names.add(file_name)
+        pipeline.put(pipeline.mailbox_queue, (file_path, reserved, f"{convert_user}/{file_name}", True))
+
+def run_stage(pipeline, stage, output_queue, *args):
+    try:
+        stage(pipeline, *args)
+        pipeline.put(output_queue, None)
+    except PipelineStopped:
+        pass
+    except Exception as e:
+        print(f" Pipeline stage {stage.__name__} failed: {str(e)}")
+        pipeline.stop()
+
+def hash_stage(pipeline, img_paths):
+    for img_path in img_paths:
+        hash_value = hash_image_file(img_path, pipeline)
+        if hash_value is None:
+            pipeline.failed = True
+            return
+        pipeline.put(pipeline.hash_queue, (img_path, hash_value))
+
+def extract_stage(pipeline):
+    while True:
+        item = pipeline.get(pipeline.hash_queue)
+        if item is None:
+            return
+        img_path, hash_value = item
+        try:
+            output_directory = get_output_directory(img_path, hash_value)
+            img_type = get_file_type(img_path)
+            img_info = read_image_file(img_path, img_type)
+            print_all_partitions_with_windows_directory(img_info, output_directory, img_path, pipeline)
+            if img_info and img_type == "E01":
+                img_info.close()
+        except Exception as e:
+            print(f" Unable to read image {img_path}: {str(e)}")
+            pipeline.failed = True
+
+def convert_stage(pipeline):
+    while True:
+        item = pipeline.get(pipeline.mailbox_queue)
+        if item is None:
+            return
+        mailbox_path, reserved, label, extracted = item
+        try:
+            csv_filename = pst_to_csv(mailbox_path)
+        except Exception as e:
+            kept = f" (copy kept at {mailbox_path})" if extracted and os.path.exists(mailbox_path) else ""
+            print(f"            - {label} -> failed: {str(e)}{kept}")
+            pipeline.disk.release(reserved)
+            continue
+
+        print(f"            - {label} -> {os.path.basename(csv_filename)}")
+        if pipeline.delete_mailboxes and extracted:
+            try:
+                os.remove(mailbox_path)
+            except OSError as e:
+                print(f" Unable to remove {mailbox_path}: {str(e)}")
+        pipeline.disk.release(reserved)
+        pipeline.put(pipeline.csv_queue, csv_filename)
+
+def get_row_size(row):
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values())
+
+def create_temp_csv(directory):
+    fd, temp_file = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    os.close(fd)
+    return temp_file
+
+def write_merged_csv(merged_filename, csv_files):
+    files = [open(csv_file, 'r', newline='', encoding='utf-8-sig') for csv_file in csv_files]
+    try:
+        readers = [csv.DictReader(file) for file in files]
+        with open(merged_filename, 'w', newline='', encoding='utf-8-sig') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDNAMES)
+            writer.writeheader()
+            for row in heapq.merge(*readers, key=get_delivery_time):
+                writer.writerow(row)
+    finally:
+        for file in files:
+            file.close()
+
+def reduce_sorted_runs(run_files, temp_dir):
+    while len(run_files) > MERGE_FAN_IN:
+        merged_runs = []
+        for index in range(0, len(run_files), MERGE_FAN_IN):
+            group = run_files[index:index + MERGE_FAN_IN]
+            merged_file = create_temp_csv(temp_dir)
+            write_merged_csv(merged_file, group)
+            for run_file in group:
+                os.remove(run_file)
+            merged_runs.append(merged_file)
+        run_files = merged_runs
+    return run_files
+
+def write_sorted_run(rows, temp_dir):
+    rows.sort(key=get_delivery_time)
+    run_file = create_temp_csv(temp_dir)
+    try:
+        with open(run_file, 'w', newline='', encoding='utf-8-sig') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDNAMES)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+    except BaseException:
+        os.remove(run_file)
+        raise
+    return run_file
+
+def sort_csv_file(csv_file, memory, temp_dir):
+    run_files = []
+    with open(csv_file, 'r', newline='', encoding='utf-8-sig') as file:
+        reader = csv.DictReader(file)
+        run_size = memory.chunk(SORT_RUN_SIZE)
+        while True:
+            reserved = memory.acquire(run_size)
+            try:
+                rows = []
+                rows_size = 0
+                for row in reader:
+                    rows.append(row)
+                    rows_size += get_row_size(row)
+                    if rows_size >= reserved:
+                        break
+                if not rows:
+                    break
+                run_files.append(write_sorted_run(rows, temp_dir))
+            finally:
+                memory.release(reserved)
+
+    run_files = reduce_sorted_runs(run_files, temp_dir)
+    if len(run_files) == 1:
+        return run_files[0]
+    sorted_file = create_temp_csv(temp_dir)
+    write_merged_csv(sorted_file, run_files)
+    for run_file in run_files:
+        os.remove(run_file)
+    return sorted_file
+
+def merge_sorted_csv_files(csv_files, sorted_files, temp_dir):
+    merged_filename = os.path.join(".", 'extract.csv')
+    write_merged_csv(merged_filename, reduce_sorted_runs(sorted_files, temp_dir))
+    print(f"\n{len(csv_files)} CSV files merged and sorted into '{merged_filename}'\n")
+
+def merge_stage(pipeline, directory):
+    temp_dir = tempfile.mkdtemp(prefix='extract-', dir='.')
+    try:
+        sorted_files = {}
+        while True:
+            csv_file = pipeline.get(pipeline.csv_queue)
+            if csv_file is None:
+                break
+            sorted_files[os.path.abspath(csv_file)] = sort_csv_file(csv_file, pipeline.memory, temp_dir)
+
+        if pipeline.failed:
+            return
+
+        csv_files = glob.glob(os.path.join(directory, '**', '*.csv'), recursive=True)
+        for csv_file in csv_files:
+            if os.path.abspath(csv_file) not in sorted_files:
+                sorted_files[os.path.abspath(csv_file)] = sort_csv_file(csv_file, pipeline.memory, temp_dir)
+        merge_sorted_csv_files(csv_files, [sorted_files[os.path.abspath(csv_file)] for csv_file in csv_files], temp_dir)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def run_pipeline(img_paths, max_memory, max_temp_disk):
+    pipeline = MailPipeline(max_memory, max_temp_disk)
+    stages = [
+        threading.Thread(target=run_stage, args=(pipeline, hash_stage, pipeline.hash_queue, img_paths), daemon=True),
+        threading.Thread(target=run_stage, args=(pipeline, extract_stage, pipeline.mailbox_queue), daemon=True),
+        threading.Thread(target=run_stage, args=(pipeline, convert_stage, pipeline.csv_queue), daemon=True),
+    ]
+    for stage in stages:
+        stage.start()
+
+    try:
+        merge_stage(pipeline, os.path.join(".", "extracted_files"))
+        for stage in stages:
+            while stage.is_alive():
+                stage.join(POLL_INTERVAL)
+    except PipelineStopped:
+        pass
+    except KeyboardInterrupt:
+        print("\n Interrupted")
+        pipeline.stop()
+    except Exception as e:
+        print(f" Pipeline stage merge_stage failed: {str(e)}")
+        pipeline.stop()
+
+    if pipeline.failed:
+        sys.exit(1)
+
+USAGE = "Usage: E01-Mail-Parser.exe [-u9] [--max-memory <size>] [--max-temp-disk <size>] <E01 file path 1> <E01 file path 2> ..."
+
+def pop_size_option(name):
+    if name not in sys.argv:
+        return None
+    index = sys.argv.index(name)
+    try:
+        value = parse_size(sys.argv[index + 1])
+    except (IndexError, ValueError, OverflowError):
+        print(USAGE)
+        sys.exit(1)
+    del sys.argv[index:index + 2]
+    return value
+
 if __name__ == "__main__":
     if '-u9' in sys.argv:
         sys.argv.remove('-u9')
-    
+
+    max_memory = pop_size_option('--max-memory')
+    max_temp_disk = pop_size_option('--max-temp-disk')
+
     if len(sys.argv) < 2:
-        print("Usage: E01-Mail-Parser.exe [-u9] <E01 file path 1> <E01 file path 2> ...")
+        print(USAGE)
         sys.exit(1)
-    
-    for img_file in sys.argv[1:]:
-        E01_to_ost_and_pst(img_file)
-    
-    merge_and_sort_csv_files(os.path.join(".", "extracted_files"))
+
+    if max_memory is not None or max_temp_disk is not None:
+        run_pipeline(sys.argv[1:], max_memory, max_temp_disk)
+    else:
+        for img_file in sys.argv[1:]:
+            E01_to_ost_and_pst(img_file)
+
+        merge_and_sort_csv_files(os.path.join(".", "extracted_files"))